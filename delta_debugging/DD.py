@@ -44,6 +44,7 @@
 
 
 import string
+from concurrent.futures import ThreadPoolExecutor
 
 # Start with some helpers.
 class OutcomeCache:
@@ -230,6 +231,11 @@ class DD:
         self.maximize = 1
         self.assume_axioms_hold = 1
 
+        # Number of tests to run in parallel (set to > 1 to enable).
+        # _test() must be safe to call from several threads at once.
+        self.jobs = 1
+        self.__prefetched = {}
+
         # Animation output (set to Animate object to enable)
         self.animate = None
 
@@ -327,7 +333,10 @@ class DD:
             print()
             print("test(" + self.coerce(c) + ")...")
 
-        outcome = self._test(c)
+        # If we already ran this test in the background, use its result
+        outcome = self.__prefetched.pop(tuple(c), None)
+        if outcome is None:
+            outcome = self._test(c)
 
         #Statistics about actually executed tests
         self.n_tests +=1
@@ -350,6 +359,31 @@ class DD:
         """Stub to overload in subclasses"""
         return self.UNRESOLVED        # Placeholder
 
+    def _test_batch(self, cs):
+        """Test each configuration in CS, using up to `jobs' threads.
+        Return the list of outcomes, in the same order as CS."""
+        if self.jobs <= 1 or len(cs) <= 1:
+            return [self._test(c) for c in cs]
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            return list(pool.map(self._test, cs))
+
+    def _prefetch(self, cs):
+        """Run the tests for the configurations in CS ahead of time,
+        in parallel.  Later calls to test() pick up their outcomes.
+        Configurations whose outcome is already known are skipped."""
+        todo = []
+        for c in cs:
+            c = sorted(c)
+            if tuple(c) in self.__prefetched:
+                continue
+            if self.cache_outcomes and self.outcome_cache.lookup(c) is not None:
+                continue
+            todo.append(c)
+
+        if todo:
+            for (c, outcome) in zip(todo, self._test_batch(todo)):
+                self.__prefetched[tuple(c)] = outcome
+
 
     def init_counting(self):
         self.n_tests  = 0
@@ -717,6 +751,26 @@ class DD:
 
                 for j in range(n):
                     i = int((j + cbar_offset) % n)
+
+                    if (self.jobs > 1 and j % self.jobs == 0 and
+                        self.minimize and not self.maximize):
+                        # Speculate that the next few complements all
+                        # pass and test them at once.  If one fails,
+                        # we only wasted the tests after it.
+                        batch = [self.__listminus(c, cs[int((k + cbar_offset) % n)])
+                                 for k in range(j, min(j + self.jobs, n))]
+
+                        # If there are workers left over, keep guessing:
+                        # if every complement passes, we will be testing
+                        # the complements of a finer split of C next.
+                        finer_n = min(len(c), n * 2)
+                        if len(batch) < self.jobs and finer_n > n:
+                            finer = self.split(c, finer_n)
+                            batch.extend([self.__listminus(c, finer[k])
+                                          for k in range(min(self.jobs - len(batch), finer_n))])
+
+                        self._prefetch(batch)
+
                     cbars[i] = self.__listminus(c, cs[i])
                     t, cbars[i] = self.test_mix(cbars[i], c, self.ADD)
                     doubled = self.__listintersect(cbars[i], cs[i])
@@ -731,6 +785,7 @@ class DD:
 
                         cbar_failed = 1
                         next_c = self.__listintersect(next_c, cbars[i])
+                        self.__prefetched = {}  # only good for the old C
                         next_n = next_n - 1
                         self.report_progress(next_c, "dd")
 
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+from array import array
+from collections import OrderedDict
+from hashlib import blake2b
+from threading import Lock
+from time import monotonic
+
+# If the deltas are split up into more than one run per this many deltas,
+# it's faster to hash all of them than to keep looking for runs
+MIN_RUN = 32
+
+class OutcomeCache(object):
+	def __init__(self, max_size=100000, min_runtime=0.2):
+		"""
+		This is a bounded cache of test outcomes, keyed on a digest of
+		the input that was tested (or of the deltas it was built
+		from).  DD's own cache holds on to every list of deltas it
+		has ever seen, which uses up all of the memory on long runs,
+		so the scripts turn it off and use this instead.  Once the
+		cache is full, the least recently used outcome is thrown
+		away.  It is safe to share between threads.
+
+		:param max_size: The most outcomes to remember
+		:type max_size: int
+		:param min_runtime: Tests which finish faster than this (in
+				seconds) are cheaper to rerun than to remember,
+				so they aren't cached
+		:type min_runtime: float
+		"""
+		self.max_size = max_size
+		self.min_runtime = min_runtime
+		self._outcomes = OrderedDict()
+		self._lock = Lock()
+
+	def __len__(self):
+		return len(self._outcomes)
+
+	def key(self, payload):
+		"""
+		This will compute the cache key for an input.
+
+		:param payload: The input passed to the target
+		:type payload: bytes
+		:returns: A digest of the input
+		:rtype: bytes
+		"""
+		return blake2b(payload, digest_size=16).digest()
+
+	def deltas_key(self, deltas):
+		"""
+		This will compute the cache key for a set of deltas, which must
+		be sorted, unique ints (e.g. offsets into the original input,
+		as DD.test() passes them to _test()).  ddmin's configurations
+		are made of a few long runs of consecutive offsets, so the key
+		is a digest of where each run starts and ends.  Finding the
+		runs only looks at O(runs * log(len(deltas))) of the deltas,
+		which is a lot cheaper than building and hashing the input.
+		If the deltas are too broken up for that to pay off, the key
+		is a digest of all of them instead.
+
+		:param deltas: The deltas being tested
+		:type deltas: list of ints
+		:returns: A digest of the runs in the deltas
+		:rtype: bytes
+		"""
+		limit = 2 * (len(deltas) // MIN_RUN + 1)
+		runs = array("q")
+		_add_runs(deltas, 0, len(deltas), runs, limit)
+		if len(runs) > limit:
+			return blake2b(array("q", deltas).tobytes(), digest_size=16,
+				person=b"deltas").digest()
+		return blake2b(runs.tobytes(), digest_size=16, person=b"runs").digest()
+
+	def get(self, key):
+		"""
+		This will look up the outcome for a key, and mark it as the
+		most recently used one.
+
+		:param key: The key returned by key() or deltas_key()
+		:type key: bytes
+		:returns: The outcome, or None if it isn't in the cache
+		"""
+		with self._lock:
+			outcome = self._outcomes.get(key)
+			if outcome is not None:
+				self._outcomes.move_to_end(key)
+			return outcome
+
+	def put(self, key, outcome):
+		"""
+		This will remember an outcome, throwing out the least
+		recently used one if the cache is full.
+
+		:param key: The key returned by key() or deltas_key()
+		:type key: bytes
+		:param outcome: The outcome of the test
+		"""
+		with self._lock:
+			self._outcomes[key] = outcome
+			self._outcomes.move_to_end(key)
+			if len(self._outcomes) > self.max_size:
+				self._outcomes.popitem(last=False)
+
+	def lookup(self, payload, run_test):
+		"""
+		This will return the cached outcome for an input, or run the
+		test and cache its outcome if it took long enough to be worth
+		remembering.
+
+		:param payload: The input passed to the target
+		:type payload: bytes
+		:param run_test: The function which runs the test, it is passed
+				the payload and returns the outcome
+		:type run_test: function
+		:returns: The outcome of the test
+		"""
+		key = self.key(payload)
+		outcome = self.get(key)
+		if outcome is not None:
+			return outcome
+		return self._run(key, payload, run_test)
+
+	def lookup_deltas(self, deltas, stringify, run_test):
+		"""
+		This is like lookup(), but the cache is keyed on the deltas
+		(see deltas_key()) rather than the input built from them, so
+		the input is only built if the test actually has to be run.
+
+		:param deltas: The deltas being tested
+		:type deltas: list of ints
+		:param stringify: The function which builds the input passed to
+				the target from the deltas
+		:type stringify: function
+		:param run_test: The function which runs the test, it is passed
+				the input and returns the outcome
+		:type run_test: function
+		:returns: The outcome of the test
+		"""
+		key = self.deltas_key(deltas)
+		outcome = self.get(key)
+		if outcome is not None:
+			return outcome
+		return self._run(key, stringify(deltas), run_test)
+
+	def _run(self, key, payload, run_test):
+		"""
+		This is a helper function which runs a test that wasn't in the
+		cache, and remembers its outcome if it took long enough.
+
+		:param key: The key returned by key() or deltas_key()
+		:type key: bytes
+		:param payload: The input passed to the target
+		:type payload: bytes
+		:param run_test: The function which runs the test
+		:type run_test: function
+		:returns: The outcome of the test
+		"""
+		start = monotonic()
+		outcome = run_test(payload)
+		if monotonic() - start >= self.min_runtime:
+			self.put(key, outcome)
+		return outcome
+
+def _add_runs(deltas, lo, hi, runs, limit):
+	"""
+	This is a helper function which adds the first and last delta of
+	each run of consecutive deltas in deltas[lo:hi] to runs.  Since the
+	deltas are sorted and unique, they are one run exactly when the
+	first and last are the right distance apart, otherwise the deltas
+	are split in half and each half is tried.  A run which was split
+	is joined back together, so a set of deltas always has the same
+	runs.  This gives up once there are more than limit ints in runs.
+
+	:param deltas: The deltas being tested
+	:type deltas: list of ints
+	:param lo: The index of the first delta to add
+	:type lo: int
+	:param hi: The index after the last delta to add
+	:type hi: int
+	:param runs: The first and last delta of each run found so far
+	:type runs: array of ints
+	:param limit: The most ints to put in runs before giving up
+	:type limit: int
+	"""
+	if lo >= hi or len(runs) > limit:
+		return
+	first = deltas[lo]
+	last = deltas[hi - 1]
+	if last - first == hi - lo - 1:
+		if runs and runs[-1] + 1 == first:
+			runs[-1] = last
+		else:
+			runs.append(first)
+			runs.append(last)
+	else:
+		mid = (lo + hi) // 2
+		_add_runs(deltas, lo, mid, runs, limit)
+		_add_runs(deltas, mid, hi, runs, limit)
@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser
+from array import array
+from bisect import bisect_right
 from gdb import Gdb, GdbException
 from logging import debug, info, error, basicConfig, INFO, DEBUG
+import re
 from sys import stdout
 
 class GdbTracer(Gdb):
@@ -42,13 +45,14 @@ class GdbTracer(Gdb):
 		"""
 		This will determine where the target program has been loaded
 		in memory.  Obviously this requires the program to have been
-		started using _start_program().  The memory range for the 
-		target is saved in a list called self.target_ranges.
+		started using _start_program().  The memory ranges for the
+		target are saved in self.target_starts and self.target_ends.
 
 		:returns: None
 		:rtype: None
 		"""
-		self.target_ranges = []
+		starts = []
+		ends = []
 		response = self._send_command("info target")
 		for line in response.splitlines():
 			line = line.strip()
@@ -57,32 +61,73 @@ class GdbTracer(Gdb):
 			if " in " in line:  # library
 				continue
 			parts = line.split(" ")
-			self.target_ranges.append( (int(parts[0], 16), int(parts[2], 16)) )
-		self._consolidate_target_ranges()
+			starts.append(int(parts[0], 16))
+			ends.append(int(parts[2], 16))
+		self._consolidate_target_ranges(starts, ends)
 
-	def _consolidate_target_ranges(self):
+	def _consolidate_target_ranges(self, starts, ends):
 		"""
-		This will consolidate contiguous ranges to make things more
-		efficient.
+		This will consolidate contiguous (or overlapping) ranges to
+		make things more efficient.  The result is sorted by start
+		address and stored as two unsigned 64-bit arrays,
+		self.target_starts and self.target_ends, so the starts can be
+		bisected and we don't carry a tuple around for every range.
 
+		:param starts: The start address of each range
+		:type starts: list of ints
+		:param ends: The end address of each range
+		:type ends: list of ints
 		:returns None:
 		:rtype: None
 		"""
-		copy = []
-		previous_start = 0
-		previous_end = 0
+		self.target_starts = array("Q")
+		self.target_ends = array("Q")
+		self._page_cache = {}  # page number -> True/False, None if it's split
 
-		for start, end in self.target_ranges:
-			if start != previous_end:  # non-contiguous, output previous range
-				if previous_start != previous_end:
-					copy.append((previous_start, previous_end))
-				previous_start = start
-			else:   # contiguous regions, include this range in the previous one
+		for start, end in sorted(zip(starts, ends)):
+			if self.target_ends and start <= self.target_ends[-1]:
+				# contiguous regions, include this range in the previous one
 				# we do this by updating the previous end, but not the previous start
-				pass
-			previous_end = end
-		copy.append((previous_start, previous_end))
-		self.target_ranges = copy
+				self.target_ends[-1] = max(self.target_ends[-1], end)
+			else:   # non-contiguous, start a new range
+				self.target_starts.append(start)
+				self.target_ends.append(end)
+		self._build_page_bits()
+
+	def _build_page_bits(self):
+		"""
+		This will build a bit vector with one bit per page, starting at
+		the first page of the target, which is set if the whole page is
+		inside the target.  Pages which are only partially inside are
+		kept in a set so they can be checked the slow way.  If the
+		target is spread out so far that the bit vector would be larger
+		than 2 MiB, self._page_bits is left as None.
+
+		:returns None:
+		:rtype: None
+		"""
+		self._page_bits = None
+		self._split_pages = set()
+		if not self.target_starts:
+			return
+		self._first_page = self.target_starts[0] >> 12
+		self._page_count = (self.target_ends[-1] >> 12) - self._first_page + 1
+		if self._page_count > 1 << 24:
+			return
+
+		bits = bytearray((self._page_count >> 3) + 1)
+		for start, end in zip(self.target_starts, self.target_ends):
+			first = start >> 12
+			last = end >> 12
+			if start & 0xfff:  # the range starts part way into a page
+				self._split_pages.add(first)
+				first += 1
+			if end & 0xfff != 0xfff:  # and (usually) ends part way into one
+				self._split_pages.add(last)
+				last -= 1
+			for page in range(first - self._first_page, last - self._first_page + 1):
+				bits[page >> 3] |= 1 << (page & 7)
+		self._page_bits = bits
 
 	def _start_program(self, args=None):
 		"""
@@ -117,8 +162,9 @@ class GdbTracer(Gdb):
 		This will start tracing a process, starting at the entry
 		point.
 
-		:param outfile: The file object where we should write the trace
-		:type outfile: IOBase
+		:param outfile: The binary file object where we should write
+				the trace
+		:type outfile: BufferedIOBase
 		:param args: The arguments to pass to the target executable
 		:type args: list of strings
 		:returns: None
@@ -137,10 +183,14 @@ class GdbTracer(Gdb):
 		# We're currently at the entry point, we want to step forward
 		# until we see the call to __libc_start_main
 		info("Running executable to __libc_start_main")
-		tmp = self._send_command("x/i $%s" % self.pc)
+		# gdb shows the auto-display after every stop, so each nexti
+		# response already contains the next instruction.
+		tmp = self._send_command("display/i $%s" % self.pc)
+		display = tmp.split(":", 1)[0]  # e.g. "1: x/i $rip"
+		next_instruction = self.next_instruction
 		while "__libc_start_main" not in tmp or "call" not in tmp:
-			self.next_instruction()
-			tmp = self._send_command("x/i $%s" % self.pc)
+			tmp = next_instruction()
+		self._send_command("undisplay %s" % display)  # keep stepi output short
 
 		arg0 = self.get_argument(0)
 		info("__libc_start_main hit.  Running to 0x%x" % arg0)
@@ -163,14 +213,38 @@ class GdbTracer(Gdb):
 		for this function is to examine instructions and step into or
 		over each instruction until the program exits.
 
-		:param outfile: The file object where we should write the trace
-		:type outfile: IOBase
+		:param outfile: The binary file object where we should write
+				the trace
+		:type outfile: BufferedIOBase
 		:returns: None
 		:rtype: None
 		"""
-		while True:  # this is horrible, but Python STILL doesn't have a post-test loop :-(
-			pc = self.info_registers([self.pc])[self.pc]
+		if self.mi:
+			return self._trace_mi(outfile)
+
+		# gdb shows the auto-display after every stop, so each step comes
+		# back with the new program counter in one round trip.  Sending a
+		# p/x along with the stepi isn't safe, since the target shares
+		# gdb's stdin and the instruction we step may read the p/x.
+		tmp = self._send_command("display/x $%s" % self.pc)
+		display = tmp.split(":", 1)[0]  # e.g. "1: /x $rip = 0x401136"
+		find_pc = re.compile(r"^%s: /x \$%s = 0x([0-9a-f]+)" % (display, self.pc),
+			re.MULTILINE).findall
+
+		# These never change, so encode them once rather than every instruction
+		step = b"stepi\n"
+		finish = b"finish\n"
 
+		# The trace is batched up and written in large chunks
+		buf = bytearray()
+
+		# This loop runs once per instruction, so look these up only once
+		write = outfile.write
+		send_raw = self._send_raw
+		not_in_kansas = self._we_are_not_in_kansas_anymore
+
+		pc = self._get_register(self.pc)
+		while pc is not None:
 			# We tried going to the next instruction when we're not
 			# in Kansas anymore, to avoid going into CALLs which
 			# are in some library, and thus be more efficient.
@@ -179,16 +253,65 @@ class GdbTracer(Gdb):
 			# So, we need to actually step into each instruction
 			# and then look at the program counter to know if we
 			# should print the program counter or not.
-			if not self._we_are_not_in_kansas_anymore(pc):
-				outfile.write("%x\n" % pc)
-				response = self.step_instruction()
+			if not not_in_kansas(pc):
+				buf += b"%x\n" % pc
+				if len(buf) > 65536:
+					write(buf)
+					buf.clear()
+				response = send_raw(step, 1)[0]
 			else:
-				response = self._send_command("finish")
+				response = send_raw(finish, 1)[0]
 
 			if "exited normally" in response or \
 				"received signal" in response or \
 				"terminated with signal" in response:
-				break
+				pc = None  # the program is gone, we're done
+			else:
+				values = find_pc(response)
+				if values:
+					pc = int(values[-1], 16)
+				else:  # e.g. the target's output got in the way
+					pc = self._get_register(self.pc)
+
+		write(buf)
+		outfile.flush()
+
+	def _trace_mi(self, outfile):
+		"""
+		This is the same as _trace(), but for when gdb was started with
+		mi=True.  The *stopped record which gdb sends after every step
+		already has the new program counter in it, so each instruction
+		only costs a single command.
+
+		:param outfile: The binary file object where we should write
+				the trace
+		:type outfile: BufferedIOBase
+		:returns: None
+		:rtype: None
+		"""
+		buf = bytearray()
+		write = outfile.write
+		send_mi = self._send_mi
+		not_in_kansas = self._we_are_not_in_kansas_anymore
+
+		pc = self._get_register(self.pc)
+		while pc is not None:
+			if not not_in_kansas(pc):
+				buf += b"%x\n" % pc
+				if len(buf) > 65536:
+					write(buf)
+					buf.clear()
+				stopped = send_mi("-exec-step-instruction")["stopped"]
+			else:
+				stopped = send_mi("-exec-finish")["stopped"]
+
+			if stopped["reason"] in ("exited-normally", "exited", "exited-signalled", "signal-received"):
+				pc = None  # the program is gone, we're done
+			else:
+				pc = int(stopped["frame"]["addr"], 16)
+
+		write(buf)
+		outfile.flush()
 
 	def _we_are_not_in_kansas_anymore(self, pc):
 		"""
@@ -200,10 +323,61 @@ class GdbTracer(Gdb):
 		:returns: True if we're off in some library, False otherwise
 		:rtype: bool
 		"""
-		for start, end in self.target_ranges:
-			if pc >= start and pc <= end:
+		if self._page_bits is not None:
+			page = (pc >> 12) - self._first_page
+			if 0 <= page < self._page_count and self._page_bits[page >> 3] & (1 << (page & 7)):
 				return False
-		return True
+			if pc >> 12 in self._split_pages:
+				return not self._in_target(pc)
+			return True
+
+		# Code has good locality, so we remember the answer per page
+		page = pc >> 12
+		try:
+			inside = self._page_cache[page]
+		except KeyError:
+			inside = self._page_cache[page] = self._page_in_target(page)
+		if inside is None:  # the page straddles the edge of a range
+			return not self._in_target(pc)
+		return not inside
+
+	def _page_in_target(self, page):
+		"""
+		This will determine if a whole page is inside the target
+		binary.
+
+		:param page: The page number (the address shifted right by 12)
+		:type page: int
+		:returns: True if the page is inside the target, False if it
+				is outside, or None if it is only partially inside
+		:rtype: bool or None
+		"""
+		low = page << 12
+		high = low | 0xfff
+		i = bisect_right(self.target_starts, low) - 1
+		if i >= 0 and high <= self.target_ends[i]:
+			return True
+		i = bisect_right(self.target_starts, high) - 1
+		if i >= 0 and self.target_ends[i] >= low:
+			return None
+		return False
+
+	def _in_target(self, pc):
+		"""
+		This will determine if an address is inside the target binary.
+
+		:param pc: The address to check
+		:type pc: int
+		:returns: True if the address is inside the target
+		:rtype: bool
+		"""
+		if len(self.target_starts) < 8:  # not worth bisecting
+			for start, end in zip(self.target_starts, self.target_ends):
+				if pc >= start and pc <= end:
+					return True
+			return False
+		i = bisect_right(self.target_starts, pc) - 1
+		return i >= 0 and pc <= self.target_ends[i]
 
 if __name__ == "__main__":
 	parser = ArgumentParser(description='Traces all branches in a program')
@@ -211,18 +385,20 @@ if __name__ == "__main__":
 	parser.add_argument('--output-file', default=None,
 				help=('The filename where we should write out the trace (Default: stdout)'))
 	parser.add_argument('--target-args', default="", help="The arguments to pass to the target binary")
+	parser.add_argument('--mi', action='store_true',
+	                    help=('Talk to gdb using the GDB/MI interface'))
 	parser.add_argument('-v', action='store_true',
 	                    help=('Verbose output (for debugging issues)'))
 	args = parser.parse_args()
 
 	basicConfig(level=(INFO, DEBUG)[args.v], format="[%(levelname)5s] %(asctime)s - %(message)s")
 	if args.output_file:
-		outfile = open(args.output_file, "w")
+		outfile = open(args.output_file, "wb", buffering=1 << 20)
 	else:
-		outfile = stdout
+		outfile = stdout.buffer
 
 	try:
-		g = GdbTracer(args.executable)
+		g = GdbTracer(args.executable, mi=args.mi)
 		g.trace(outfile, args.target_args.split(" "))
 	except GdbException as e:
 		error(str(e))
@@ -1,14 +1,62 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser
+import os
+import pty
+import re
+import termios
 from logging import debug, info, error, basicConfig, INFO, DEBUG
 from select import select
+from signal import SIGKILL
 from subprocess import Popen, PIPE, STDOUT
+from time import monotonic
+
+# What gdb says when it can't talk to a gdb server
+REMOTE_ERRORS = ("Connection timed out", "Connection refused",
+	"Remote communication error")
+
+def kill_descendants(pid):
+	"""
+	This will kill every process started by a process (and by those
+	processes, and so on), but not the process itself.  This needs
+	/proc, so elsewhere it does nothing.
+
+	:param pid: The process whose descendants should be killed
+	:type pid: int
+	:returns: None
+	:rtype: None
+	"""
+	children = {}
+	try:
+		pids = [int(entry) for entry in os.listdir("/proc") if entry.isdigit()]
+	except OSError:
+		return
+	for child in pids:
+		try:
+			with open("/proc/%d/stat" % child, "rb") as f:
+				stat = f.read()
+		except OSError:
+			continue  # it's already gone
+		# The command name is in parentheses and may contain spaces
+		ppid = int(stat[stat.rindex(b")") + 2:].split()[1])
+		children.setdefault(ppid, []).append(child)
+
+	pending = children.get(pid, [])
+	while pending:
+		child = pending.pop()
+		pending.extend(children.get(child, []))
+		try:
+			os.kill(child, SIGKILL)
+		except ProcessLookupError:
+			pass
 
 class GdbException(Exception):
 	pass
 
+class GdbTimeout(GdbException):
+	pass
+
 class Gdb(object):
-	def __init__(self, executable=None, discard_output=True, args=None, prompt="(gdb) "):
+	def __init__(self, executable=None, discard_output=True, args=None, prompt="(gdb) ", mi=False):
 		"""
 		This will start an instance of gdb.  By default, it will
 		consume and discard any information read in before the
@@ -16,7 +64,8 @@ class Gdb(object):
 		read in manually, set keep_output to True.  If any extra
 		arguments are desired, they can be passed in as well.  If
 		your system uses a non-standard prompt, this can be
-		specified.
+		specified.  Set mi to True to talk to gdb using the GDB/MI
+		machine interface, see _send_mi().
 
 		:param executable: The program to load for debugging
 		:type executable: string
@@ -27,17 +76,47 @@ class Gdb(object):
 		:type args: list of strings
 		:param prompt: The gdb prompt that your system uses
 		:type prompt: string
+		:param mi: If true, gdb is started with the GDB/MI interpreter
+		:type mi: bool
 		"""
 		self.prompt = prompt
+		self.mi = mi
+		self._prompt = prompt.encode()
+		self._buffer = bytearray()  # output read past the last prompt
+		self._register_re = re.compile(r"^(\w+)\s+0x([0-9a-f]+)", re.MULTILINE)
+		# Where a GDB/MI record could start part way into a line
+		self._mi_record_re = re.compile(r'\d*(?:[\^*+=][a-z-]+(?:,|$)|[~@&]")')
 
 		_args = ["gdb", "-q", "-nx"] # quiet, don't execute ~/.gdbinit
+		# gdb thinks it's talking to a person now, so tell it not to
+		# stop and ask us questions or wrap/color what it prints
+		for setting in ("pagination off", "confirm off", "width 0",
+		                "height 0", "style enabled off"):
+			_args.extend(["-iex", "set " + setting])
+		if mi:
+			_args.append("--interpreter=mi3")
 		if args:
 			debug("args = %s" % repr(args))
 			_args.extend(args)
 		if executable:
 			_args.append(executable)
 
-		self.p = Popen(_args, bufsize=0, universal_newlines=True, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
+		# gdb (and the program it runs) get a pty for their output, so
+		# everything comes back line buffered instead of in whatever
+		# chunks a pipe happens to get.  Input stays on a pipe, since a
+		# terminal would mangle binary input to the target and there'd
+		# be no way to send it an EOF.
+		master, slave = pty.openpty()
+		attrs = termios.tcgetattr(slave)
+		attrs[1] &= ~termios.ONLCR # don't turn "\n" into "\r\n"
+		attrs[3] &= ~termios.ECHO
+		termios.tcsetattr(slave, termios.TCSANOW, attrs)
+		try:
+			self.p = Popen(_args, bufsize=0, stdin=PIPE, stdout=slave, stderr=STDOUT)
+		finally:
+			os.close(slave)
+		self._master = open(master, "rb", buffering=0) # closes master when we go away
+		self._fd = master
 		if discard_output:
 			self.read_to_prompt()
 
@@ -53,41 +132,88 @@ class Gdb(object):
 		:returns: The output of GDB (potentially including the prompt)
 		:rtype: string
 		"""
-		data = ""
+		data = bytes(self._buffer)
+		self._buffer.clear()
 
-		while self.p.stdout in select([self.p.stdout], [], [], 0)[0]:
-			line = self.p.stdout.readline()
-			if line == "": # Nothing left to read
+		# Give gdb a moment to finish writing, so we don't return
+		# half of a burst of output
+		while select([self._fd], [], [], 0.001)[0]:
+			chunk = self._read_chunk()
+			if chunk == b"": # Nothing left to read
 				break
-			data += line
+			data += chunk
 
-		return data
+		return data.decode("utf-8", errors="replace")
 
-	def read_to_prompt(self):
+	def read_to_prompt(self, timeout=None):
 		"""
 		This will read the output from gdb up to the prompt.
 		This is a blocking call, so it will hold up execution
 		until something happens to interrupt the debugger (a
 		breakpoint, signal, etc.) which causes the gdb prompt
-		to be displayed.
+		to be displayed.  If a timeout is given and the prompt
+		doesn't show up in time, a GdbTimeout will be raised.
 
+		:param timeout: How long to wait for the prompt, in seconds
+				(Default: forever)
+		:type timeout: float
 		:returns: The output of GDB, excluding the prompt
 		:rtype: string
 		"""
-		data = ""
-		line = ""
-
-		while line != self.prompt:
-			try:
-				line += self.p.stdout.read(1)
-				if line.endswith("\n"):
-					data += line
-					line = ""
-			except UnicodeDecodeError:
-				pass  # gdb is spitting out garbage, ignore it
+		buf = self._buffer
+		end = self._find_prompt(0)
+		if timeout is not None:
+			deadline = monotonic() + timeout
+		while end < 0:
+			start = max(len(buf) - len(self._prompt), 0)
+			if timeout is not None:
+				remaining = deadline - monotonic()
+				if remaining <= 0 or not select([self._fd], [], [], remaining)[0]:
+					raise GdbTimeout("Timed out waiting for the gdb prompt")
+			chunk = self._read_chunk()
+			if not chunk:  # gdb is gone, hand back whatever we have
+				end = len(buf)
+				break
+			buf.extend(chunk)
+			end = self._find_prompt(start)
 
+		data = buf[:end].decode("utf-8", errors="replace")
+		del buf[:end + len(self._prompt)]
 		return data
 
+	def _read_chunk(self):
+		"""
+		This is a helper function which reads whatever gdb has written
+		to the pty.  Once gdb exits, reading the master side of a pty
+		fails with EIO rather than returning an empty string, so that
+		is turned into the usual end of file.
+
+		:returns: The data read, or an empty string if gdb is gone
+		:rtype: bytes
+		"""
+		try:
+			return os.read(self._fd, 65536)
+		except OSError:
+			return b""
+
+	def _find_prompt(self, start):
+		"""
+		This is a helper function which finds the prompt in the data
+		we've buffered up.  Only a prompt at the beginning of a line
+		counts.
+
+		:param start: Where in the buffer to start looking
+		:type start: int
+		:returns: The offset of the prompt, or -1 if there is none
+		:rtype: int
+		"""
+		if start == 0 and self._buffer.startswith(self._prompt):
+			return 0
+		i = self._buffer.find(b"\n" + self._prompt, start)
+		if i < 0:
+			return i
+		return i + 1
+
 	def quit(self):
 		"""
 		Quit GDB
@@ -98,6 +224,18 @@ class Gdb(object):
 		self._send_command("quit", read_to_prompt=False)
 		self.p = None
 
+	def kill(self):
+		"""
+		Kill GDB, along with the program it's debugging.  If only gdb
+		is killed, a program which is stuck keeps running on its own.
+
+		:returns: None
+		:rtype: None
+		"""
+		kill_descendants(self.p.pid)
+		self.p.kill()
+		self.p.wait()
+
 	def set_breakpoint(self, symbol):
 		"""
 		This will place a breakpoint at the symbol.  The symbol could
@@ -156,23 +294,28 @@ class Gdb(object):
 		"""
 		if self.pc == "rip":
 			if index == 0:
-				return self.info_registers(["rdi"])["rdi"]
+				return self._get_register("rdi")
 			else:
 				raise GdbException("get_argument only implemented for arg 0")
 		else:
 			raise GdbException("get_argument currently only implemented for AMD64")
 
-	def run(self, args=None, read_to_prompt=False):
+	def run(self, args=None, read_to_prompt=False, timeout=None):
 		"""
 		This will run the executable passed in via the constructor.
 		If any command line arguments should be passed to the target
-		binary, they can be specified.
+		binary, they can be specified.  If the output is read and the
+		target doesn't stop within the timeout, a GdbTimeout will be
+		raised.
 
 		:param args: The arguments to pass to the target executable
 		:type args: list of strings
 		:param read_to_prompt: Should the output be read & returned, or
 				should it be left in the output buffer?
 		:type read_to_prompt: bool
+		:param timeout: How long to wait for the target, in seconds
+				(Default: forever)
+		:type timeout: float
 		:returns: If read_to_prompt is True, output from gdb will be
 				returned.  Otherwise and empty string
 				will be returned.
@@ -181,7 +324,7 @@ class Gdb(object):
 		cmd = "r"
 		if args:
 			cmd += " %s" % " ".join(args)
-		return self._send_command(cmd, read_to_prompt)
+		return self._send_command(cmd, read_to_prompt, timeout)
 
 	def continue_execution(self, read_to_prompt=False):
 		"""
@@ -213,6 +356,40 @@ class Gdb(object):
 			raise GdbException(response)
 		return response
 
+	def target_extended_remote(self, host, port):
+		"""
+		This will attach to a gdb server running in multi-process mode
+		(gdbserver --multi).  Unlike target_remote, the connection
+		stays up when the program exits, so it can be run again
+		without restarting anything.  Use set_remote_exec_file to
+		tell the server which program to run.  If gdb can't connect
+		to the server, a GdbException will be raised.
+
+		:param host: This should be the host to connect to
+		:type host: string
+		:param port: This should be the port to connect to
+		:type port: integer
+		:returns: output from GDB
+		:rtype: string
+		"""
+		response = self._send_command("target extended-remote %s:%d" % (host, port))
+		for failure in REMOTE_ERRORS:
+			if failure in response:
+				raise GdbException(response)
+		return response
+
+	def set_remote_exec_file(self, path):
+		"""
+		This will set the program which a gdb server in multi-process
+		mode should start when the run command is issued.
+
+		:param path: The path of the program on the server
+		:type path: string
+		:returns: output from GDB
+		:rtype: string
+		"""
+		return self._set("remote exec-file", path)
+
 	def detach(self):
 		"""
 		This will detach from a remote gdb server.
@@ -279,13 +456,47 @@ class Gdb(object):
 		args = ["registers"]
 		if registers:
 			args.extend(registers)
-		response = self._info(args)
+		return self._parse_registers(self._info(args))
+
+	def _parse_registers(self, response):
+		"""
+		This is a helper function used to parse the output of
+		"info registers".
+
+		:param response: The output from gdb
+		:type response: string
+		:returns: The contents of all registers in the response
+		:rtype: dictionary, keys are register names
+		"""
 		retval = {}
-		for line in response.splitlines():
-			parts = line.split()
-			retval[parts[0]] = int(parts[1], 16)
+		for match in self._register_re.finditer(response):
+			retval[match.group(1)] = int(match.group(2), 16)
 		return retval
 
+	def _get_register(self, name):
+		"""
+		This will get the value of a single register.  This is cheaper
+		than info_registers() since gdb only prints one hex number.
+
+		:param name: The register you are interested in
+		:type name: string
+		:returns: The contents of the register
+		:rtype: int
+		"""
+		return self._parse_value(self._send_command("p/x $%s" % name))
+
+	def _parse_value(self, response):
+		"""
+		This is a helper function used to parse the output of a
+		"p/x" command, e.g. "$1 = 0x401136".
+
+		:param response: The output from gdb
+		:type response: string
+		:returns: The value which was printed
+		:rtype: int
+		"""
+		return int(response.rsplit("=", 1)[1], 16)
+
 	def _info(self, args):
 		"""
 		This is a helper function used to get info from gdb.
@@ -314,7 +525,7 @@ class Gdb(object):
 		"""
 		return self._send_command("set %s %s" % (var, value), read_to_prompt=True)
 
-	def _send_command(self, cmd, read_to_prompt=True):
+	def _send_command(self, cmd, read_to_prompt=True, timeout=None):
 		"""
 		This will send a command to gdb and then read the output until
 		it gets a prompt, unless instructed otherwise.
@@ -324,13 +535,194 @@ class Gdb(object):
 		:param read_to_prompt: Should the output be read & returned, or
 				should it be left in the output buffer?
 		:type read_to_prompt: bool
+		:param timeout: How long to wait for the prompt, in seconds
+				(Default: forever)
+		:type timeout: float
 		:returns: The output from gdb, or an empty string if the output
 				is not read.
 		:rtype: string
 		"""
-		return self.send_input("%s\n" % cmd, read_to_prompt).strip()
+		if self.mi and read_to_prompt:
+			# Console output is what a CLI command would have printed
+			return self._send_mi(cmd, timeout)["console"].strip()
+		self.send_input("%s\n" % cmd, read_to_prompt=False)
+		if not read_to_prompt:
+			return ""
+		return self.read_to_prompt(timeout).strip()
 
-	def send_EOF(self, read_to_prompt=True):
+	def _send_mi(self, cmd, timeout=None):
+		"""
+		This will send a command to gdb when it was started with
+		mi=True, and parse the reply.  CLI commands work too.  If the
+		command starts the target (e.g. -exec-step-instruction), this
+		will wait until the target stops again.  If gdb reports an
+		error or exits, a GdbException will be raised.  If the reply
+		takes longer than the timeout, a GdbTimeout will be raised.
+
+		:param cmd: The command to send to GDB
+		:type cmd: string
+		:param timeout: How long to wait for the reply (and for the
+				target to stop), in seconds (Default: forever)
+		:type timeout: float
+		:returns: The results from the result record, plus "class"
+				(e.g. "done"), "console" (anything gdb printed to
+				the console) and, if the target ran, "stopped" (the
+				results from the *stopped record)
+		:rtype: dictionary
+		"""
+		self.send_input("%s\n" % cmd, read_to_prompt=False)
+		reply = {"console": ""}
+		if timeout is not None:
+			deadline = monotonic() + timeout
+		while "class" not in reply or (reply["class"] == "running" and "stopped" not in reply):
+			if timeout is not None:
+				output = self.read_to_prompt(max(deadline - monotonic(), 0))
+			else:
+				output = self.read_to_prompt()
+			if not output and self.p.poll() is not None:
+				raise GdbException("gdb exited with code %d" % self.p.returncode)
+			for line in output.splitlines():
+				record = self._parse_mi_record(line)
+				if record is None:
+					continue
+				kind, name, results = record
+				if kind == "~":
+					reply["console"] += name
+				elif kind == "^":
+					reply.update(results)
+					reply["class"] = name
+				elif kind == "*" and name == "stopped":
+					reply["stopped"] = results
+
+		if reply["class"] == "error":
+			raise GdbException(reply.get("msg", reply["console"]))
+		return reply
+
+	def _parse_mi_record(self, line):
+		"""
+		This is a helper function used to parse one line of GDB/MI
+		output, e.g. '^done,value="1"' or '~"Hello\\n"'.  If the
+		target printed something without a newline, the record is
+		found after it.
+
+		:param line: The line of output
+		:type line: string
+		:returns: A tuple of the record type (the first character, e.g.
+				"^" or "*"), the class (e.g. "done"; for stream
+				records this is the text instead) and the results
+				(None for stream records), or None if the line is
+				not a record (e.g. the prompt)
+		:rtype: tuple of (string, string, dictionary)
+		"""
+		record = self._parse_mi_line(line)
+		if record is None:
+			# The target shares gdb's terminal, so a record can come
+			# right after something it printed without a newline
+			for match in self._mi_record_re.finditer(line, 1):
+				record = self._parse_mi_line(line[match.start():])
+				if record is not None:
+					break
+		return record
+
+	def _parse_mi_line(self, line):
+		"""
+		This is a helper function used by _parse_mi_record() to parse a
+		line which starts with a GDB/MI record.
+
+		:param line: The line of output
+		:type line: string
+		:returns: The same as _parse_mi_record()
+		:rtype: tuple of (string, string, dictionary)
+		"""
+		line = line.lstrip("0123456789")  # skip the token, if any
+		kind = line[:1]
+		try:
+			if kind in ("~", "@", "&"):
+				return kind, self._parse_mi_value(line, 1)[0], None
+			if kind in ("^", "*", "+", "="):
+				name, _, rest = line[1:].partition(",")
+				return kind, name, self._parse_mi_results(rest, 0, "")[0]
+		except (ValueError, IndexError):
+			pass  # not a record after all, the target printed it
+		return None
+
+	def _parse_mi_results(self, text, i, end):
+		"""
+		This is a helper function used to parse a comma separated list
+		of GDB/MI results (name=value) into a dictionary.
+
+		:param text: The text to parse
+		:type text: string
+		:param i: Where to start parsing
+		:type i: int
+		:param end: The character which ends the list (e.g. "}"), or an
+				empty string if it runs to the end of the text
+		:type end: string
+		:returns: The results and the offset of the end character
+		:rtype: tuple of (dictionary, int)
+		"""
+		results = {}
+		while i < len(text) and text[i] != end:
+			j = text.index("=", i)
+			results[text[i:j]], i = self._parse_mi_value(text, j + 1)
+			if i < len(text) and text[i] == ",":
+				i += 1
+		return results, i
+
+	def _parse_mi_value(self, text, i):
+		"""
+		This is a helper function used to parse a single GDB/MI value:
+		a C string, a tuple ({...}, which becomes a dictionary) or a
+		list ([...]).  For lists of results, only the values are kept.
+
+		:param text: The text to parse
+		:type text: string
+		:param i: Where the value starts
+		:type i: int
+		:returns: The value and the offset just past it
+		:rtype: tuple of (string, dictionary or list; and int)
+		"""
+		if text[i] == '"':
+			j = i + 1
+			while text[j] != '"':
+				j += 2 if text[j] == "\\" else 1
+			value = text[i + 1:j].encode("latin-1", "backslashreplace").decode("unicode_escape")
+			return value, j + 1
+		if text[i] == "{":
+			value, i = self._parse_mi_results(text, i + 1, "}")
+			return value, i + 1
+		value = []
+		i += 1
+		while text[i] != "]":
+			if text[i] not in "\"{[":  # a result, we only want the value
+				i = text.index("=", i) + 1
+			item, i = self._parse_mi_value(text, i)
+			value.append(item)
+			if text[i] == ",":
+				i += 1
+		return value, i + 1
+
+	def _send_raw(self, data, count):
+		"""
+		This will write commands which have already been encoded
+		straight to gdb, and then read the output of each of them.
+		This skips all of the formatting and logging, which adds up
+		in loops which send the same commands over and over again.
+		The target shares gdb's stdin, so only the last command may
+		resume it (e.g. stepi or continue), otherwise the target could
+		read the commands after it as input.
+
+		:param data: The commands, each one terminated by a newline
+		:type data: bytes
+		:param count: The number of commands in data
+		:type count: int
+		:returns: The output from gdb for each command, in order
+		:rtype: list of strings
+		"""
+		self.p.stdin.write(data)
+		return [self.read_to_prompt().strip() for i in range(count)]
+
+	def send_EOF(self, read_to_prompt=True, timeout=None):
 		"""
 		This will send an EOF (end of file) character to gdb.  If the
 		target executable is running, this will be sent to that program.
@@ -339,6 +731,9 @@ class Gdb(object):
 		:param read_to_prompt: Should the output be read & returned, or
 				should it be left in the output buffer?
 		:type read_to_prompt: bool
+		:param timeout: How long to wait for the prompt, in seconds
+				(Default: forever)
+		:type timeout: float
 		:returns: The output from gdb, or an empty string if the output
 				is not read.
 		:rtype: string
@@ -347,7 +742,7 @@ class Gdb(object):
 		debug("Sending EOF GDB")
 		self.p.stdin.close()
 		if read_to_prompt:
-			output = self.read_to_prompt()
+			output = self.read_to_prompt(timeout)
 		return output.strip()
 
 	def send_input(self, data, read_to_prompt=True):
@@ -357,7 +752,7 @@ class Gdb(object):
 		a breakpoint, gdb will process the input as commands.
 
 		:param data: The data to send to GDB
-		:type data: string
+		:type data: string or bytes
 		:param read_to_prompt: Should the output be read & returned, or
 				should it be left in the output buffer?
 		:type read_to_prompt: bool
@@ -366,8 +761,10 @@ class Gdb(object):
 		:rtype: string
 		"""
 		output = ""
+		if not isinstance(data, bytes):
+			data = data.encode()
 		debug("Sending data to GDB: %s" % data.strip())
-		self.p.stdin.write("%s" % data)
+		self.p.stdin.write(data)
 		if read_to_prompt:
 			output = self.read_to_prompt()
 		return output.strip()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+# Below this many deltas, it's faster to copy the bytes one at a time
+# than to keep splitting the deltas up looking for runs
+SMALL_RUN = 32
+
+def build_payload(data, deltas):
+	"""
+	This will build the input for a test from the original input and
+	the offsets of the bytes to keep.  ddmin's configurations are made
+	of a few long runs of consecutive offsets, so each of those is
+	copied as a single slice instead of one byte at a time.
+
+	:param data: The original input
+	:type data: bytes
+	:param deltas: The offsets of the bytes to keep, sorted and with
+			no duplicates (as DD.test() passes them to _test())
+	:type deltas: list of ints
+	:returns: The bytes at those offsets
+	:rtype: bytes
+	"""
+	pieces = []
+	_add_runs(data, deltas, 0, len(deltas), pieces)
+	return b"".join(pieces)
+
+def _add_runs(data, deltas, lo, hi, pieces):
+	"""
+	This is a helper function which adds the bytes for deltas[lo:hi]
+	to pieces.  Since the deltas are sorted and unique, they are one
+	run exactly when the first and last are the right distance apart,
+	otherwise the deltas are split in half and each half is tried.
+
+	:param data: The original input
+	:type data: bytes
+	:param deltas: The offsets of the bytes to keep
+	:type deltas: list of ints
+	:param lo: The index of the first delta to add
+	:type lo: int
+	:param hi: The index after the last delta to add
+	:type hi: int
+	:param pieces: The list to add the bytes to
+	:type pieces: list of bytes
+	"""
+	if lo >= hi:
+		return
+	first = deltas[lo]
+	last = deltas[hi - 1]
+	if last - first == hi - lo - 1:
+		pieces.append(data[first:last + 1])
+	elif hi - lo <= SMALL_RUN:
+		pieces.append(bytes(map(data.__getitem__, deltas[lo:hi])))
+	else:
+		mid = (lo + hi) // 2
+		_add_runs(data, deltas, lo, mid, pieces)
+		_add_runs(data, deltas, mid, hi, pieces)
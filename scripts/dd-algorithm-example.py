@@ -16,16 +16,13 @@ class TestDD(DD):
 		self.verbose = 0
 
 	def _test(self, deltas):
-		# Build input file
-		found = []
-		for (index, byte) in deltas:
-			if byte == "1" or byte == "7" or byte == "8":
-				found.append(byte)
+		# Fail if all of the "bad" characters are present
+		found = {byte for (index, byte) in deltas if byte in ("1", "7", "8")}
 
 		ret = self.PASS
-		if found.count("1") == 1 and found.count("7") == 1 and found.count("8") == 1:
+		if found == {"1", "7", "8"}:
 			ret = self.FAIL
-		print('Testing case {:11}: {}'.format('"' + "".join([x[1] for x in deltas]) + '"', str(ret)))
+		print('Testing case {:11}: {}'.format('"' + "".join(x[1] for x in deltas) + '"', str(ret)))
 		return ret
 
 if __name__ == '__main__':
@@ -33,11 +30,11 @@ if __name__ == '__main__':
 	print('Minimizing input: "{}"'.format(test_input))
 
 	# Convert string into the delta format
-	deltas = list(map(lambda x: (x, test_input[x]), range(len(test_input))))
+	deltas = list(enumerate(test_input))
 
 	mydd = TestDD()
 	c = mydd.ddmin(deltas)              # Invoke DDMIN
 
-	minimal = "".join([x[1] for x in c])
+	minimal = "".join(x[1] for x in c)
 	print('Found minimal test case: "{}"'.format(minimal))
 
@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser
 from logging import basicConfig, DEBUG, INFO, WARNING, debug, info, error
-from os import unlink
+from os import killpg, unlink
+from signal import SIGKILL
 from subprocess import TimeoutExpired, Popen, PIPE, STDOUT
 from sys import stdin
 from tempfile import mkstemp
@@ -10,6 +11,8 @@ from time import sleep
 
 try:
 	from delta_debugging.DD import DD
+	from delta_debugging.cache import OutcomeCache
+	from delta_debugging.payload import build_payload
 	from delta_debugging.gdb import Gdb
 except ImportError as e:
 	print("Unable to import delta debugging library.  Please ensure it is "
@@ -22,29 +25,48 @@ class MyDD(DD):
 		DD.__init__(self)
 		self.executable = executable
 		self.target_args = target_args
+		self.timeout = None
 		if loglevel >= INFO:
 			self.debug_dd = 0
 			self.verbose = 0
 		else:
 			self.debug_dd = 1
 			self.verbose = 1
+		# The original input, the deltas are offsets into it
+		self.data = b""
 		# Caching results in a memory explosion for long runs
 		self.cache_outcomes = 0
+		self._outcomes = OutcomeCache()
         
 	def _test(self, deltas):
+		# ddmin retests the same input a lot, so check the cache first
+		return self._outcomes.lookup_deltas(deltas, self.stringify, self._run_test)
+
+	def _run_test(self, payload):
 		# Build input
 		input_filename = mkstemp(prefix="avprobe-crash-", suffix=".ogg")[1]
 
 		_args = [self.executable, input_filename]
 		with open(input_filename, "wb") as f:
-			for (index, byte) in deltas:
-				f.write(bytes([byte]))
-		p = Popen(_args, universal_newlines=True, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-		p.wait()
+			f.write(payload)
+		p = Popen(_args, stdin=PIPE, stdout=PIPE, stderr=STDOUT,
+			  start_new_session=True)
+		timed_out = False
+		try:
+			# drain the output so the target can't block on a full pipe
+			p.communicate(timeout=self.timeout)
+		except TimeoutExpired:
+			killpg(p.pid, SIGKILL)  # the target and anything it started
+			p.communicate()
+			timed_out = True
 
 		# Clean up our remporary files
 		unlink(input_filename)
 
+		if timed_out:
+			info("Timed out after %s seconds" % self.timeout)
+			return self.UNRESOLVED
+
 		#info("Return code: %d" % p.returncode)
 		if p.returncode == 0:
 			return self.PASS
@@ -56,10 +78,7 @@ class MyDD(DD):
 		return self.FAIL
 
 	def stringify(self, deltas):
-		data = []
-		for (index, byte) in deltas:
-			data.append(byte)
-		return "".join(data)
+		return build_payload(self.data, deltas)
 
 if __name__ == '__main__':
 	parser = ArgumentParser(description=("Sample program to find the minimum input which "
@@ -71,6 +90,10 @@ if __name__ == '__main__':
 	parser.add_argument('--output-file', default="crash-minimal.ogg",
 				help=('The output file to create (Default: crash-minimal.ogg)'))
 	parser.add_argument('--target-args', default="", help="The arguments to pass to the target binary")
+	parser.add_argument('--jobs', type=int, default=1,
+				help=('The number of tests to run in parallel (Default: 1)'))
+	parser.add_argument('--timeout', type=float, default=None,
+				help=('Give up on a test after this many seconds (Default: no limit)'))
 	parser.add_argument('-q', action='store_true', help=('Quite mode (overrides -v if both are given)'))
 	parser.add_argument('-v', action='store_true', help=('Verbose output (for debugging issues)'))
 
@@ -83,32 +106,30 @@ if __name__ == '__main__':
 		loglevel = INFO
 
 	basicConfig(format="[%(levelname)s] %(asctime)s - %(message)s", level=loglevel)
+	# Load the input file, each delta is the offset of one of its bytes
 	if args.input_file:
 		debug("Using input file: %s" % args.input_file)
-		infile = open(args.input_file, "rb")
+		with open(args.input_file, "rb") as infile:
+			data = infile.read()
 	else:
-		infile = stdin
-
-	# Load deltas from input file
-	deltas = []
-	index = 1
-	for character in infile.read():
-		deltas.append((index, character))
-		index = index + 1
+		data = stdin.buffer.read()
+	deltas = list(range(len(data)))
 
 	if args.target_args:
 		mydd = MyDD(args.executable, args.target_args.split(" "), loglevel)
 	else:
 		mydd = MyDD(args.executable, [], loglevel)
+	mydd.jobs = args.jobs
+	mydd.timeout = args.timeout
+	mydd.data = data
 	info("Simplifying failure-inducing input...")
 	c = mydd.ddmin(deltas)              # Invoke DDMIN
 	with open(args.output_file, "wb") as f:
-		for (index, byte) in c:
-			f.write(bytes([byte]))
+		f.write(mydd.stringify(c))
 	info("The 1-minimal failure-inducing input has been saved to %s" % args.output_file)
 	info("Removing any element will make the failure go away.")
 
 	# debug("Isolating the failure-inducing difference...")
 	# (c, c1, c2) = mydd.dd(deltas)	# Invoke DD
-	# info("The 1-minimal failure-inducing difference is", c)
-	# info(mydd.stringify(c1), "passes,", mydd.stringify(c2), "fails")
+	# info("The 1-minimal failure-inducing difference is %s", c)
+	# info("%r passes, %r fails", mydd.stringify(c1), mydd.stringify(c2))
@@ -1,15 +1,18 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser
 from logging import basicConfig, DEBUG, INFO, WARNING, debug, info, error
-from os import unlink
-from subprocess import TimeoutExpired
+from os import close, unlink, write
+from socket import create_connection
+from subprocess import TimeoutExpired, Popen, DEVNULL
 from sys import stdin
 from tempfile import mkstemp
-from threading import Thread
+from time import monotonic, sleep
 
 try:
 	from delta_debugging.DD import DD
-	from delta_debugging.gdb import Gdb
+	from delta_debugging.cache import OutcomeCache
+	from delta_debugging.payload import build_payload
+	from delta_debugging.gdb import Gdb, GdbException, GdbTimeout, kill_descendants
 except ImportError as e:
 	print("Unable to import delta debugging library.  Please ensure it is "
 		"installed.  https://github.com/grimm-co/delta-debugging")
@@ -17,75 +20,146 @@ except ImportError as e:
 	exit(-1)
 
 class GdbDD(DD):
-	def __init__(self, executable, target_args, loglevel=INFO):
+	def __init__(self, executable, target_args, loglevel=INFO, gdbserver_port=None):
 		DD.__init__(self)
 		self.executable = executable
 		self.target_args = target_args
+		self.gdbserver_port = gdbserver_port
 		if loglevel >= INFO:
 			self.debug_dd = 0
 			self.verbose = 0
 		else:
 			self.debug_dd = 1
 			self.verbose = 1
+		# The original input, the deltas are offsets into it
+		self.data = b""
 		# Caching results in a memory explosion for long runs
 		self.cache_outcomes = 0
+		self._outcomes = OutcomeCache()
+		# One gdb is reused for every test, so the symbols are only loaded once
+		self._gdb = None
+		self.gdb_timeout = 5
+		self._gdbserver = None
+		if gdbserver_port:
+			# The server stays up between runs, so each test is just a "run"
+			info("Starting gdbserver on port %d" % gdbserver_port)
+			self._gdbserver = Popen(["gdbserver", "--multi", ":%d" % gdbserver_port],
+						stdout=DEVNULL, stderr=DEVNULL)
+			self.wait_for_gdbserver()
+
+	def wait_for_gdbserver(self, timeout=5):
+		"""
+		This will wait for the gdbserver we started to accept
+		connections, so gdb doesn't try to connect before it's ready.
+		gdbserver --multi keeps listening after a connection is
+		closed, so checking doesn't use it up.
 
-	def wait_for_gdb(self, gdb):
+		:param timeout: How long to wait (in seconds)
+		:type timeout: float
+		"""
+		deadline = monotonic() + timeout
+		while True:
+			if self._gdbserver.poll() is not None:
+				raise GdbException("gdbserver exited with code %d" % self._gdbserver.returncode)
+			try:
+				create_connection(("localhost", self.gdbserver_port), timeout=1).close()
+				return
+			except OSError as e:
+				if monotonic() >= deadline:
+					self._gdbserver.kill()
+					self._gdbserver.wait()
+					raise GdbException("gdbserver isn't accepting connections: %s" % e)
+			sleep(0.05)
+
+	def wait_for_gdb(self, p):
 		"""
-		This will run GDB in a separate thread.
+		This will wait for gdb to exit, and kill it if it doesn't
+		finish in time.
 		"""
 		try:
-			info("Starting watchdog thread")
-			if gdb.p:  # our process is gone, hooray
-				info("Checking to see if gdb is finished")
-				gdb.p.wait(timeout=5)
-				if gdb.p and gdb.p.returncode is None:  # If gdb isn't finished by now...
-					gdb.p.kill()          # kill it
-			else:
-				info("GDB has finished")
+			info("Checking to see if gdb is finished")
+			p.wait(timeout=5)
 		except TimeoutExpired:
-			pass
+			p.kill()  # If gdb isn't finished by now, kill it
+			p.wait()
+
+	def close(self):
+		"""
+		This will quit the gdb instance used by _test() and the
+		gdbserver, if any.
+		"""
+		if self._gdb:
+			if self._gdbserver:
+				self._gdb._send_command("monitor exit")
+			p = self._gdb.p
+			self._gdb.quit()
+			self.wait_for_gdb(p)
+			self._gdb = None
+		elif self._gdbserver:
+			# No gdb is connected to tell it to exit
+			self._gdbserver.kill()
+		if self._gdbserver:
+			self.wait_for_gdb(self._gdbserver)
+			self._gdbserver = None
 
 	def _test(self, deltas):
-		# Build input file
-		input_filename = mkstemp(prefix="ccd2cue-crash-", suffix=".ccd")[1]
-		with open(input_filename, "wb") as f:
-			for (index, byte) in deltas:
-				f.write(bytes([byte]))
+		# ddmin retests the same input a lot, so check the cache first
+		return self._outcomes.lookup_deltas(deltas, self.stringify, self._run_test)
 
-		g = Gdb(self.executable)
+	def _run_test(self, payload):
+		# Build input file
+		fd, input_filename = mkstemp(prefix="ccd2cue-crash-", suffix=".ccd")
+		write(fd, payload)
+		close(fd)
+
+		if self._gdb is None:
+			g = Gdb(self.executable)
+			if self._gdbserver:
+				try:
+					g.target_extended_remote("localhost", self.gdbserver_port)
+				except GdbException:
+					g.kill()
+					unlink(input_filename)
+					raise
+				g.set_remote_exec_file(self.executable)
+			self._gdb = g
+		g = self._gdb
 
 		# Append the input filename to the target args & run
-		args = []
-		for entry in self.target_args:
-			args.append(entry)
-		args.append(input_filename)
+		args = [*self.target_args, input_filename]
 		debug("Running: {} {}".format(self.executable, " ".join(args)))
-		t = Thread(target=self.wait_for_gdb, kwargs={"gdb": g})
-		t.start()  # Start waiting for gdb
-		response = g.run(args=args, read_to_prompt=True)
+		try:
+			response = g.run(args=args, read_to_prompt=True, timeout=self.gdb_timeout)
+		except GdbTimeout:
+			# Start over with a new gdb rather than trying to interrupt this one
+			error("ccd2cue didn't finish in {} seconds".format(self.gdb_timeout))
+			g.kill()
+			if self._gdbserver:
+				# The target belongs to gdbserver, which stays up
+				kill_descendants(self._gdbserver.pid)
+			self._gdb = None
+			unlink(input_filename)
+			return self.UNRESOLVED
 		debug("gdb response = {}".format(response))
 
-		# Clean up our temporary files
+		# Clean up our temporary files and whatever is left of the target
 		unlink(input_filename)
+		g._send_command("kill")
 
 		# Check for cases where we didn't crash
 		if ("exited normally" in response or "exited with code" in response):
-			g.quit()
-			t.join()
 			return self.PASS
 
 		if "SIGABRT" in response:
-			g.quit()
-			t.join()
 			return self.FAIL
 
 		# Shouldn't ever happen
 		error("Unhandled exception occurred {}".format(response))
-		g.quit()
-		t.join()
 		return self.UNRESOLVED
 
+	def stringify(self, deltas):
+		return build_payload(self.data, deltas)
+
 if __name__ == '__main__':
 	parser = ArgumentParser(description=("Delta debugging test script to determine the minimum input "
 					"which will still crash ccd2cue."))
@@ -94,6 +168,10 @@ if __name__ == '__main__':
 				help=('The filename of the crashing input (Default: stdin)'))
 	parser.add_argument('--target-args', default="", help="The arguments to pass to the ccd2cue "
         "(excluding the input file)")
+	parser.add_argument('--gdbserver-port', type=int, default=None,
+				help=('Run ccd2cue under "gdbserver --multi" on this port (Default: run it under gdb)'))
+	parser.add_argument('--timeout', type=float, default=5,
+				help=('Give up on a test after this many seconds (Default: 5)'))
 	parser.add_argument('-q', action='store_true', help=('Quite mode (overrides -v if both are given)'))
 	parser.add_argument('-v', action='store_true', help=('Verbose output (for debugging issues)'))
 
@@ -106,28 +184,28 @@ if __name__ == '__main__':
 		loglevel = INFO
 
 	basicConfig(format="[%(levelname)s] %(asctime)s - %(message)s", level=loglevel)
+	# Load the input file, each delta is the offset of one of its bytes
 	if args.input_file:
 		debug("Using input file: {}".format(args.input_file))
-		infile = open(args.input_file, "rb")
+		with open(args.input_file, "rb") as infile:
+			data = infile.read()
 	else:
-		infile = stdin
-
-	# Load deltas from input file
-	deltas = []
-	index = 1
-	for character in infile.read():
-		deltas.append((index, character))
-		index = index + 1
+		data = stdin.buffer.read()
+	deltas = list(range(len(data)))
 
 	if args.target_args:
-		mydd = GdbDD(args.executable, args.target_args.split(" "), loglevel)
+		mydd = GdbDD(args.executable, args.target_args.split(" "), loglevel, args.gdbserver_port)
 	else:
-		mydd = GdbDD(args.executable, [], loglevel)
+		mydd = GdbDD(args.executable, [], loglevel, args.gdbserver_port)
+	mydd.data = data
+	mydd.gdb_timeout = args.timeout
 	info("Simplifying failure-inducing input...")
-	c = mydd.ddmin(deltas)              # Invoke DDMIN
+	try:
+		c = mydd.ddmin(deltas)              # Invoke DDMIN
+	finally:
+		mydd.close()
 	with open("crash-minimal.ccd", "wb") as f:
-		for (index, byte) in c:
-			f.write(bytes([byte]))
+		f.write(mydd.stringify(c))
 	info("The 1-minimal failure-inducing input has been saved to crash-minimal.ccd")
 	info("Removing any element will make the failure go away.")
 
@@ -5,6 +5,9 @@ from sys import stdin
 
 try:
 	from delta_debugging.DD import DD
+	from delta_debugging.cache import OutcomeCache
+	from delta_debugging.payload import build_payload
+	from delta_debugging.gdb import Gdb, GdbTimeout
 except ImportError as e:
 	print("Unable to import delta debugging library.  Please ensure it is "
 		"installed.  See https://github.com/grimm-co/delta-debugging "
@@ -19,15 +22,18 @@ class GdbDD(DD):
 		self.breakpoint = breakpoint
 		self.debug_dd = (0, 1)[verbose]
 		self.verbose = (0, 1)[verbose]
+		self.timeout = None
+		# The original input, the deltas are offsets into it
+		self.data = b""
 		# Caching results in a memory explosion for long runs
 		self.cache_outcomes = 0
+		self._outcomes = OutcomeCache()
         
 	def _test(self, deltas):
-		# Build input
-		data = []
-		for (index, byte) in deltas:
-			data.append((index, byte))
+		# ddmin retests the same input a lot, so check the cache first
+		return self._outcomes.lookup_deltas(deltas, self.stringify, self._run_test)
 
+	def _run_test(self, payload):
 		g = Gdb(self.executable)	
 		breakpoint_number, addr = g.set_breakpoint(self.breakpoint)
 		debug("Breakpoint %d set at %s" % (breakpoint_number, addr))
@@ -36,8 +42,13 @@ class GdbDD(DD):
 		g.run(read_to_prompt=False)
 
 		debug("Sending input to GDB")
-		g.send_input(self.stringify(data), read_to_prompt=False)
-		response = g.send_EOF()
+		g.send_input(payload, read_to_prompt=False)
+		try:
+			response = g.send_EOF(timeout=self.timeout)
+		except GdbTimeout:
+			info("Timed out after %s seconds" % self.timeout)
+			g.kill()
+			return self.UNRESOLVED
 
 		if "breakpoint" in response.lower():
 			debug("Breakpoint hit")
@@ -49,10 +60,7 @@ class GdbDD(DD):
 		return self.UNRESOLVED
 
 	def stringify(self, deltas):
-		data = []
-		for (index, byte) in deltas:
-			data.append(byte)
-		return "".join(data)
+		return build_payload(self.data, deltas)
 
 	def target_crashed(self):
 		s = socket(AF_INET, SOCK_STREAM)
@@ -74,23 +82,23 @@ if __name__ == '__main__':
 				help=('The filename of the interesting/crashing input (Default: stdin)'))
 	#parser.add_argument('good_input_file', help=('The filename of the non-interesting input'))
 	#parser.add_argument('crash_input_file', help=('The filename of the interesting/crashing input'))
+	parser.add_argument('--timeout', type=float, default=None,
+				help=('Give up on a test after this many seconds (Default: no limit)'))
 	parser.add_argument('-v', action='store_true', help=('Verbose output (for debugging issues)'))
 
 	args = parser.parse_args()
 	basicConfig(format="[%(levelname)s] %(asctime)s - %(message)s", level=(INFO, DEBUG)[args.v])
+	# Load the input file, each delta is the offset of one of its bytes
 	if args.input_file:
-		infile = open(args.input_file, "rb")
+		with open(args.input_file, "rb") as infile:
+			data = infile.read()
 	else:
-		infile = stdin
-
-	# Load deltas from input file
-	deltas = []
-	index = 1
-	for character in infile.read():
-		deltas.append((index, character))
-		index = index + 1
+		data = stdin.buffer.read()
+	deltas = list(range(len(data)))
 
 	mydd = GdbDD(args.executable, args.breakpoint, args.v)
+	mydd.data = data
+	mydd.timeout = args.timeout
 	info("Simplifying failure-inducing input...")
 	c = mydd.ddmin(deltas)              # Invoke DDMIN
 	info("The 1-minimal failure-inducing input is %s" % mydd.stringify(c))
@@ -98,5 +106,5 @@ if __name__ == '__main__':
 
 	# debug("Isolating the failure-inducing difference...")
 	# (c, c1, c2) = mydd.dd(deltas)	# Invoke DD
-	# info("The 1-minimal failure-inducing difference is", c)
-	# info(mydd.stringify(c1), "passes,", mydd.stringify(c2), "fails")
+	# info("The 1-minimal failure-inducing difference is %s", c)
+	# info("%r passes, %r fails", mydd.stringify(c1), mydd.stringify(c2))
@@ -1,15 +1,26 @@
 #!/usr/bin/python3
 from argparse import ArgumentParser
 from logging import basicConfig, DEBUG, INFO, WARNING, debug, info, error
-from os import close, unlink
+from os import close, killpg, lseek, unlink, write, SEEK_SET
+from os.path import isdir
+from signal import SIGKILL
 from subprocess import TimeoutExpired, Popen, PIPE, STDOUT
 from sys import stdin
 from tempfile import mkstemp
 from threading import Thread
 from time import sleep
 
+try:
+	from os import memfd_create
+except ImportError:  # Only available on Linux
+	memfd_create = None
+# Otherwise, use a tmpfs if there is one, so the input doesn't hit the disk
+SHM_DIR = "/dev/shm" if isdir("/dev/shm") else None
+
 try:
 	from delta_debugging.DD import DD
+	from delta_debugging.cache import OutcomeCache
+	from delta_debugging.payload import build_payload
 except ImportError as e:
 	print("Unable to import delta debugging library.  Please ensure it is "
 		"installed.  https://github.com/grimm-co/delta-debugging ")
@@ -22,36 +33,64 @@ class MyDD(DD):
 		self.executable = executable
 		self.target_args = target_args
 		self.streaming = streaming
+		self.timeout = None
+		# Only the @@ arguments change between tests, so build the rest once
+		self._argv = [executable, *target_args]
+		self._input_slots = [i + 1 for (i, x) in enumerate(target_args) if x == "@@"]
 		if loglevel >= INFO:
 			self.debug_dd = 0
 			self.verbose = 0
 		else:
 			self.debug_dd = 1
 			self.verbose = 1
+		# The original input, the deltas are offsets into it
+		self.data = b""
 		# Caching results in a memory explosion for long runs
 		self.cache_outcomes = 0
+		self._outcomes = OutcomeCache()
         
 	def _test(self, deltas):
-		# Build input
-		_, input_filename = mkstemp(prefix="crash-")
-		close(_)  # We just wanted the unique filename, not an open file descriptor...
+		# ddmin retests the same input a lot, so check the cache first
+		return self._outcomes.lookup_deltas(deltas, self.stringify, self._run_test)
 
-		_args = [self.executable]
-		if self.target_args:
-			_args.extend([x if x != "@@" else input_filename for x in self.target_args])
+	def _run_test(self, payload):
+		# Build input.  The target gets the fd either way, so an in-memory
+		# file can be opened through /proc without ever having a name.
+		if memfd_create:
+			fd = memfd_create("crash")
+			input_filename = "/proc/self/fd/%d" % fd
+		else:
+			fd, input_filename = mkstemp(prefix="crash-", dir=SHM_DIR)
+		try:
+			write(fd, payload)
+			lseek(fd, 0, SEEK_SET)
 
-		with open(input_filename, "wb") as f:
-			for (index, byte) in deltas:
-				f.write(bytes([byte]))
-		p = Popen(_args, stdin=PIPE, stdout=PIPE, stderr=STDOUT, close_fds=True)
-		if self.streaming:
-			with open(input_filename, "rb") as infile:
-				p.stdin.write(infile.read())
-			p.stdin.close()
-		p.wait()
+			_args = self._argv
+			if self._input_slots:
+				_args = _args[:]
+				for i in self._input_slots:
+					_args[i] = input_filename
 
-		# Clean up our remporary files
-		unlink(input_filename)
+			target_stdin = fd if self.streaming else PIPE
+			p = Popen(_args, stdin=target_stdin, stdout=PIPE, stderr=STDOUT, close_fds=True,
+				  pass_fds=(fd,), start_new_session=True)
+			timed_out = False
+			try:
+				# drain the output so the target can't block on a full pipe
+				p.communicate(timeout=self.timeout)
+			except TimeoutExpired:
+				killpg(p.pid, SIGKILL)  # the target and anything it started
+				p.communicate()
+				timed_out = True
+		finally:
+			# Clean up our remporary files
+			close(fd)
+			if not memfd_create:
+				unlink(input_filename)
+
+		if timed_out:
+			info("Timed out after %s seconds" % self.timeout)
+			return self.UNRESOLVED
 
 		debug("Return code: %d" % p.returncode)
 		if p.returncode == 0:
@@ -64,10 +103,7 @@ class MyDD(DD):
 		return self.FAIL
 
 	def stringify(self, deltas):
-		data = []
-		for (index, byte) in deltas:
-			data.append(byte)
-		return "".join(data)
+		return build_payload(self.data, deltas)
 
 if __name__ == '__main__':
 	parser = ArgumentParser(description=("Sample program to find the minimum input which "
@@ -80,6 +116,10 @@ if __name__ == '__main__':
 				help=('The output file to create (Default: crash-minimal)'))
 	parser.add_argument('--target-args', default="", help="The arguments to pass to the target binary (use @@ for input file)")
 	parser.add_argument('-s', action='store_true', help=('Push file through stdin to target application'))
+	parser.add_argument('--jobs', type=int, default=1,
+				help=('The number of tests to run in parallel (Default: 1)'))
+	parser.add_argument('--timeout', type=float, default=None,
+				help=('Give up on a test after this many seconds (Default: no limit)'))
 	parser.add_argument('-q', action='store_true', help=('Quite mode (overrides -v if both are given)'))
 	parser.add_argument('-v', action='store_true', help=('Verbose output (for debugging issues)'))
 
@@ -92,32 +132,30 @@ if __name__ == '__main__':
 		loglevel = INFO
 
 	basicConfig(format="[%(levelname)s] %(asctime)s - %(message)s", level=loglevel)
+	# Load the input file, each delta is the offset of one of its bytes
 	if args.input_file:
 		debug("Using input file: %s" % args.input_file)
-		infile = open(args.input_file, "rb")
+		with open(args.input_file, "rb") as infile:
+			data = infile.read()
 	else:
-		infile = stdin
-
-	# Load deltas from input file
-	deltas = []
-	index = 1
-	for character in infile.read():
-		deltas.append((index, character))
-		index = index + 1
+		data = stdin.buffer.read()
+	deltas = list(range(len(data)))
 
 	if args.target_args:
 		mydd = MyDD(args.executable, args.target_args.split(" "), args.s, loglevel)
 	else:
 		mydd = MyDD(args.executable, [], args.s, loglevel)
+	mydd.jobs = args.jobs
+	mydd.timeout = args.timeout
+	mydd.data = data
 	info("Simplifying failure-inducing input...")
 	c = mydd.ddmin(deltas)              # Invoke DDMIN
 	with open(args.output_file, "wb") as f:
-		for (index, byte) in c:
-			f.write(bytes([byte]))
+		f.write(mydd.stringify(c))
 	info("The 1-minimal failure-inducing input has been saved to %s" % args.output_file)
 	info("Removing any element will make the failure go away.")
 
 	debug("Isolating the failure-inducing difference...")
 	(c, c1, c2) = mydd.dd(deltas)	# Invoke DD
 	info("The 1-minimal failure-inducing difference is %s", c)
-	info(mydd.stringify(c1), "passes,", mydd.stringify(c2), "fails")
+	info("%r passes, %r fails", mydd.stringify(sorted(c1)), mydd.stringify(sorted(c2)))
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
-from socket import socket, AF_INET, SOCK_STREAM
+from socket import socket, timeout, AF_INET, SOCK_STREAM
 from subprocess import Popen, PIPE
+from time import monotonic
 try:
 	from delta_debugging.DD import DD
 except ImportError as e:
@@ -18,58 +19,123 @@ class MyDD(DD):
 		self.debug_dd = 1
 		# Caching results in a memory explosion for long runs
 		self.cache_outcomes = 0
-        
+		# Reusing one connection for every test saves a handshake per
+		# test, but is only valid if the target handles each message on
+		# its own (i.e. the protocol is stateless).  VNC isn't, every
+		# input would carry on the session left by the ones before it.
+		self.reuse_connection = False
+		self.sock = None
+		# How long the target has to go quiet for us to believe it's done
+		# with an input.  Every passing test waits this long, so keep it
+		# short unless the target is slow to answer or to die.
+		self.quiet_time = 0.01
+
+	def _connect(self):
+		s = socket(AF_INET, SOCK_STREAM)
+		s.connect((HOST, PORT))
+		self.sock = s
+
+	def _disconnect(self):
+		if self.sock is not None:
+			self.sock.close()
+			self.sock = None
+
+	def _drain(self, wait):
+		"""
+		This will read whatever the target sends until it goes quiet,
+		so it can't be mistaken for the answer to a later input.
+
+		:param wait: How long (in seconds) to wait for the target to
+				say something more, 0 to only read what's already
+				arrived
+		:type wait: float
+		:returns: False if the target closed or reset the connection
+		:rtype: bool
+		"""
+		# Don't wait forever on a target that never stops talking
+		deadline = monotonic() + 10 * max(wait, self.quiet_time)
+		self.sock.settimeout(wait)
+		try:
+			while monotonic() < deadline:
+				if not self.sock.recv(65536):
+					return False
+		except (timeout, BlockingIOError):
+			pass
+		except (ConnectionResetError, BrokenPipeError):
+			return False
+		return True
+
 	def _test(self, deltas):
 		# Build input
-		data = []
-		for (index, byte) in deltas:
-			data.append(byte)
+		payload = bytes(byte for (index, byte) in deltas)
 
 		# Write input to `input.c'
 		#out = open('input.tmp', 'wb')
-		#out.write(bytes(data))
+		#out.write(payload)
 		#out.close()
 
 		#print(self.coerce(deltas))
 
-		s = socket(AF_INET, SOCK_STREAM)
 		try:
-			s.connect((HOST, PORT))
-			if data:
-				s.sendall(bytes("".join(data), "UTF-8"))
+			# Throw away anything left over from the last test.  If the
+			# connection died since then, that's not this input's fault.
+			if self.sock is not None and not self._drain(0):
+				self._disconnect()
+			if self.sock is None:
+				self._connect()
+		except Exception as e:
+			print("EXCEPTION: %s" % str(e))
+			self._disconnect()
+			return self.UNRESOLVED
 
-			if self.target_crashed():
-				return self.FAIL
-			return self.PASS
+		try:
+			if payload:
+				self.sock.settimeout(None)  # _drain() may have left it non-blocking
+				self.sock.sendall(payload)
+
+			# If the target is still up, it answers and/or keeps quiet
+			# until the timeout.  Reading the whole answer means a crash
+			# right after answering is still pinned on this input.
+			alive = self._drain(self.quiet_time)
+		except (ConnectionResetError, BrokenPipeError):
+			alive = False
 		except Exception as e:
 			print("EXCEPTION: %s" % str(e))
-		return self.UNRESOLVED
+			self._disconnect()
+			return self.UNRESOLVED
 
-	def coerce(self, deltas):
-		# Pretty-print the configuration
-		data = []
-		for (index, byte) in deltas:
-			data.append(byte)
-		return data
+		if alive:
+			if not self.reuse_connection:
+				self._disconnect()
+			return self.PASS
 
-	def target_crashed(self):
-		s = socket(AF_INET, SOCK_STREAM)
+		# Our connection is gone, but maybe the target just hung up on
+		# us.  If we can't get a new one, it crashed.  A target which is
+		# still dying may accept the connection and then drop it, so
+		# make sure the new one stays up.
+		self._disconnect()
 		try:
-			s.connect((HOST, PORT))
-			s.close()
-			return False
-		except Exception as e:
+			self._connect()
+			alive = self._drain(self.quiet_time)
+		except OSError as e:
 			print("%s - %s" % (type(e), str(e)))
-			return True
+			alive = False
+		if not alive:
+			self._disconnect()
+			return self.FAIL
+		if not self.reuse_connection:
+			self._disconnect()
+		return self.PASS
+
+	def coerce(self, deltas):
+		# Pretty-print the configuration
+		return bytes(byte for (index, byte) in deltas)
 
 if __name__ == '__main__':
 	mydd = MyDD()
 	# Load deltas from input file
-	deltas = []
-	index = 1
-	for character in open('crash_delta').read():
-		deltas.append((index, character))
-		index = index + 1
+	with open('crash_delta', 'rb') as infile:
+		deltas = list(enumerate(infile.read(), 1))
 
     
 	print("Simplifying failure-inducing input...")
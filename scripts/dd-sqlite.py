@@ -1,15 +1,21 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser
 from logging import basicConfig, DEBUG, INFO, WARNING, debug, info, error
-from os import unlink
+from os import close, unlink, write
+from os.path import isdir
 from subprocess import TimeoutExpired
 from sys import stdin
 from tempfile import mkstemp
-from threading import Thread
 from time import sleep
 
+# Use a tmpfs if there is one, so the inputs don't hit the disk
+SHM_DIR = "/dev/shm" if isdir("/dev/shm") else None
+
 try:
 	from delta_debugging.DD import DD
+	from delta_debugging.cache import OutcomeCache
+	from delta_debugging.payload import build_payload
+	from delta_debugging.gdb import Gdb, GdbException
 except ImportError as e:
 	print("Unable to import delta debugging library.  Please ensure it is "
 		"installed.  https://www.st.cs.uni-saarland.de/askigor/downloads/")
@@ -27,98 +33,113 @@ class GdbDD(DD):
 		else:
 			self.debug_dd = 1
 			self.verbose = 1
+		# The original input, the deltas are offsets into it
+		self.data = b""
 		# Caching results in a memory explosion for long runs
 		self.cache_outcomes = 0
+		self._outcomes = OutcomeCache()
+		# One gdb is reused for every test, so the symbols are only loaded once
+		self._gdb = None
+		self.gdb_timeout = 5
         
-	def wait_for_gdb(self, gdb):
+	def wait_for_gdb(self, p):
 		"""
-		This will run GDB in a separate thread.
+		This will wait for gdb to exit, and kill it if it doesn't
+		finish in time.
 		"""
 		try:
-			info("Starting watchdog thread")
-			if gdb.p:  # our process is gone, horray
-				info("Checking to see if gdb is finished")
-				gdb.p.wait(timeout=5)
-				if gdb.p and gdb.p.returncode is None:  # If gdb isn't finished by now...
-					gdb.p.kill()          # kill it
-			else:
-				info("GDB has finished")
+			info("Checking to see if gdb is finished")
+			p.wait(timeout=5)
 		except TimeoutExpired:
-			pass
+			p.kill()  # If gdb isn't finished by now, kill it
+			p.wait()
+
+	def close(self):
+		"""
+		This will quit the gdb instance used by _test().
+		"""
+		if self._gdb:
+			p = self._gdb.p
+			self._gdb.quit()
+			self.wait_for_gdb(p)
+			self._gdb = None
 
 	def _test(self, deltas):
-		# Build input
-		input_filename = mkstemp(prefix="sqlite3-crash-", suffix=".sql")[1]
-		db_filename = mkstemp(prefix="sqlite3-", suffix=".db")[1]
-		with open(input_filename, "wb") as f:
-			for (index, byte) in deltas:
-				f.write(bytes([byte]))
+		# ddmin retests the same input a lot, so check the cache first
+		return self._outcomes.lookup_deltas(deltas, self.stringify, self._run_test)
 
-		g = Gdb(self.executable)	
-		debug("Running %s" % self.executable)
-		g._send_command("set disassembly-flavor intel")
+	def _run_test(self, payload):
+		# Build input
+		fd, input_filename = mkstemp(prefix="sqlite3-crash-", suffix=".sql", dir=SHM_DIR)
+		write(fd, payload)
+		close(fd)
+		fd, db_filename = mkstemp(prefix="sqlite3-", suffix=".db", dir=SHM_DIR)
+		close(fd)
+
+		if self._gdb is None:
+			debug("Starting gdb for %s", self.executable)
+			self._gdb = Gdb(self.executable, mi=True)
+			self._gdb._send_mi("-gdb-set disassembly-flavor intel")
+		g = self._gdb
 
 		# Append the stream redirection from our tempfile to the target args & run
-		args = []
-		for entry in self.target_args:
-			args.append(entry)
-		args.extend([db_filename, "<", input_filename])
-		debug("target_args: %s" % args)
-		t = Thread(target=self.wait_for_gdb, kwargs={"gdb": g})
-		t.start()  # Start waiting for gdb
-		debug("Running gdb")
-		response = g.run(args=args, read_to_prompt=True)
-		debug("Gdb exited or hit exception")
-		debug("response = %s" % response)
+		args = [*self.target_args, db_filename, "<", input_filename]
+		debug("target_args: %s", args)
+		try:
+			g._send_mi("-exec-arguments %s" % " ".join(args))
+			debug("Running the target")
+			stopped = g._send_mi("-exec-run", timeout=self.gdb_timeout)["stopped"]
+		except GdbException as e:
+			# Whatever happened, this gdb isn't any use anymore
+			error("Giving up on this test: %s", e)
+			g.kill()
+			self._gdb = None
+			stopped = None
+		debug("Target exited or hit exception")
+		debug("stopped = %s", stopped)
 
 		# Clean up our remporary files
 		unlink(input_filename)
 		unlink(db_filename)
 
+		if stopped is None:
+			return self.UNRESOLVED
+
 		# Check for cases where we didn't crash
-		if "exited normally" in response:   # We're done
-			g.quit()
-			t.join()
-			return self.PASS
-		if "exited with code" in response:  # We're done
-			g.quit()
-			t.join()
+		reason = stopped.get("reason")
+		if reason in ("exited-normally", "exited"):   # We're done
 			return self.PASS
 
-		try:
-			g._determine_pc()
-			addr = g.info_registers([g.pc])[g.pc]
-			#if addr == 0:
-			#	g.quit()
-			#	return self.PASS  # We don't want the pointer to be at the NULL page
-			info("Faulted at 0x%x" % addr)
-		except ValueError as e:
-			error("Unable to determine faulting addr %s %s" % (str(e), response))
-
-		if "SIGABRT" in response:
-			g.quit()
-			t.join()
+		# If the target stopped on a signal instead of being killed by
+		# it, it's still around, get rid of it before the next run
+		if reason != "exited-signalled":
+			try:
+				g._send_mi("kill", timeout=self.gdb_timeout)
+			except GdbException as e:
+				error("Unable to kill the target, restarting gdb: %s", e)
+				g.kill()
+				self._gdb = None
+
+		signal = stopped.get("signal-name")
+		addr = stopped.get("frame", {}).get("addr", "")
+		info("%s at %s", signal, addr)
+		#if int(addr, 16) == 0:
+		#	return self.PASS  # We don't want the pointer to be at the NULL page
+
+		if signal == "SIGABRT":
 			return self.PASS  # This isn't the crash we are looking for
 			#return self.FAIL  # I changed my mind, we do care about this
-		elif "SIGSEGV" in response and "a99410" in response:
+		elif signal == "SIGSEGV" and "a99410" in addr:
 			#target_rip = "0x0000000000a99410"
-			#response = g._send_command("x/gx $rip")
-			g.quit()
-			t.join()
 			return self.FAIL  # This is the crash we care about
-			#if target_rip in response:
+			#if target_rip in addr:
 			#	return self.FAIL  # This is the crash we care about
 			#return self.PASS  # This isn't the crash we are looking for
-		error("WTF just happened? %s" % response)
-		g.quit()
-		t.join()
+		error("WTF just happened? %s" % stopped)
 		return self.UNRESOLVED
 
 	def stringify(self, deltas):
-		data = []
-		for (index, byte) in deltas:
-			data.append(byte)
-		return "".join(data)
+		return build_payload(self.data, deltas)
 
 	def target_crashed(self):
 		s = socket(AF_INET, SOCK_STREAM)
@@ -138,6 +159,8 @@ if __name__ == '__main__':
 	parser.add_argument('--input-file', default=None,
 				help=('The filename of the crashing input (Default: stdin)'))
 	parser.add_argument('--target-args', default="", help="The arguments to pass to the target binary")
+	parser.add_argument('--timeout', type=float, default=5,
+				help=('Give up on a test after this many seconds (Default: 5)'))
 	parser.add_argument('-q', action='store_true', help=('Quite mode (overrides -v if both are given)'))
 	parser.add_argument('-v', action='store_true', help=('Verbose output (for debugging issues)'))
 
@@ -150,32 +173,32 @@ if __name__ == '__main__':
 		loglevel = INFO
 
 	basicConfig(format="[%(levelname)s] %(asctime)s - %(message)s", level=loglevel)
+	# Load the input file, each delta is the offset of one of its bytes
 	if args.input_file:
 		debug("Using input file: %s" % args.input_file)
-		infile = open(args.input_file, "rb")
+		with open(args.input_file, "rb") as infile:
+			data = infile.read()
 	else:
-		infile = stdin
-
-	# Load deltas from input file
-	deltas = []
-	index = 1
-	for character in infile.read():
-		deltas.append((index, character))
-		index = index + 1
+		data = stdin.buffer.read()
+	deltas = list(range(len(data)))
 
 	if args.target_args:
 		mydd = GdbDD(args.executable, args.target_args.split(" "), loglevel)
 	else:
 		mydd = GdbDD(args.executable, [], loglevel)
+	mydd.data = data
+	mydd.gdb_timeout = args.timeout
 	info("Simplifying failure-inducing input...")
-	c = mydd.ddmin(deltas)              # Invoke DDMIN
+	try:
+		c = mydd.ddmin(deltas)              # Invoke DDMIN
+	finally:
+		mydd.close()
 	with open("crash-minimal.sql", "wb") as f:
-		for (index, byte) in c:
-			f.write(bytes([byte]))
+		f.write(mydd.stringify(c))
 	info("The 1-minimal failure-inducing input has been saved to crash-minimal.sql")
 	info("Removing any element will make the failure go away.")
 
 	# debug("Isolating the failure-inducing difference...")
 	# (c, c1, c2) = mydd.dd(deltas)	# Invoke DD
-	# info("The 1-minimal failure-inducing difference is", c)
-	# info(mydd.stringify(c1), "passes,", mydd.stringify(c2), "fails")
+	# info("The 1-minimal failure-inducing difference is %s", c)
+	# info("%r passes, %r fails", mydd.stringify(c1), mydd.stringify(c2))
@@ -1,15 +1,23 @@
 #!/usr/bin/env python3
 from argparse import ArgumentParser
-from logging import basicConfig, DEBUG, INFO, WARNING, debug, info, error
-from os import unlink
+from logging import basicConfig, getLogger, DEBUG, INFO, WARNING, debug, info, error
+from os import close, killpg, read, unlink, urandom, write
+from pty import openpty
+from queue import Queue, Empty
+from select import select, PIPE_BUF
+from signal import SIGKILL
+from sqlite3 import complete_statement
 from subprocess import TimeoutExpired, Popen, PIPE, STDOUT
 from sys import stdin
 from tempfile import mkstemp
+from termios import tcgetattr, tcsetattr, ONLCR, TCSANOW
 from threading import Thread
-from time import sleep
+from time import monotonic, sleep
 
 try:
 	from delta_debugging.DD import DD
+	from delta_debugging.cache import OutcomeCache
+	from delta_debugging.payload import build_payload
 except ImportError as e:
 	print("Unable to import delta debugging library.  Please ensure it is "
 		"installed.  https://github.com/grimm-co/delta-debugging")
@@ -21,50 +29,214 @@ class MyDD(DD):
 		DD.__init__(self)
 		self.executable = executable
 		self.target_args = target_args
+		self.timeout = None
 		if loglevel >= INFO:
 			self.debug_dd = 0
 			self.verbose = 0
 		else:
 			self.debug_dd = 1
 			self.verbose = 1
+		# The original input, the deltas are offsets into it
+		self.data = b""
 		# Caching results in a memory explosion for long runs
 		self.cache_outcomes = 0
+		self._outcomes = OutcomeCache()
+		# sqlite processes which are kept around between tests, so we
+		# don't pay for starting one up every time
+		self._workers = Queue()
+		# How long a worker gets when there's no --timeout
+		self.worker_timeout = 5
+		self._sentinel = b"__dd_%s__" % urandom(8).hex().encode()
         
+	def close(self):
+		"""
+		This will stop all of the sqlite workers.
+		"""
+		while True:
+			try:
+				worker = self._workers.get_nowait()
+			except Empty:
+				break
+			self._stop_worker(worker)
+
+	def _start_worker(self):
+		"""
+		This will start a sqlite process to run tests in.  Its output
+		goes to a pty, so it is line buffered and we can tell when it
+		has finished a test.
+
+		:returns: The process and the master side of its pty
+		:rtype: tuple
+		"""
+		master, slave = openpty()
+		attrs = tcgetattr(slave)
+		attrs[1] &= ~ONLCR # don't turn "\n" into "\r\n"
+		tcsetattr(slave, TCSANOW, attrs)
+		try:
+			p = Popen([self.executable], stdin=PIPE, stdout=slave, stderr=STDOUT)
+		finally:
+			close(slave)
+		return (p, master)
+
+	def _stop_worker(self, worker):
+		p, master = worker
+		if p.poll() is None:
+			p.kill()
+		p.wait()
+		p.stdin.close()
+		close(master)
+
+	def _fits_in_worker(self, payload):
+		"""
+		This will check whether a test can be run in a worker.  sqlite
+		has to be able to finish every statement in the input, otherwise
+		it swallows the sentinel into an unclosed string, comment or
+		trigger, and we would wait for the worker to time out.  Inputs
+		with dot-commands also need a process of their own, since they
+		change shell settings which reopening the database won't reset.
+
+		:param payload: The input to test
+		:type payload: bytes
+		:returns: True if the test can be run in a worker
+		:rtype: bool
+		"""
+		if payload.startswith(b".") or b"\n." in payload:
+			return False
+		try:
+			# Like the worker, end the input with a ";" so a missing
+			# one at the end doesn't count
+			return complete_statement(payload.decode("latin-1") + "\n;")
+		except ValueError:  # it has a NUL, which the shell would cut off
+			return False
+
+	def _run_in_worker(self, worker, payload):
+		"""
+		This will run a test in a worker.  The database is reopened
+		first, so temp tables, pragmas and attached databases from the
+		last test are gone, and once sqlite is done with the input it
+		is asked to print a sentinel, which tells us it is still alive
+		and ready for the next test.
+
+		:param worker: A worker returned by _start_worker()
+		:type worker: tuple
+		:param payload: The input to test
+		:type payload: bytes
+		:returns: The return code if sqlite exited, or None if it is
+				still alive
+		:rtype: int
+		"""
+		p, master = worker
+		data = (b".bail off\n.echo off\n.output stdout\n.open :memory:\n" +
+			payload + b"\n;\n.print\n.print " + self._sentinel + b"\n")
+		marker = b"\n" + self._sentinel + b"\n"
+		stdin_fd = p.stdin.fileno()
+
+		view = memoryview(data)
+		tail = b""
+		limit = self.worker_timeout if self.timeout is None else self.timeout
+		deadline = monotonic() + limit
+		while True:
+			remaining = deadline - monotonic()
+			if remaining <= 0:
+				raise TimeoutExpired(self.executable, limit)
+			readable, writable, _ = select([master], [stdin_fd] if view else [], [], remaining)
+			if writable:
+				try:
+					# A pipe that's writable has room for PIPE_BUF bytes
+					view = view[write(stdin_fd, view[:PIPE_BUF]):]
+				except BrokenPipeError:
+					view = view[:0]  # it's gone, we'll see EOF below
+			if readable:
+				try:
+					chunk = read(master, 65536)
+				except OSError:  # EIO, once sqlite has exited
+					chunk = b""
+				if not chunk:
+					return p.wait()
+				if marker in tail + chunk:
+					return None
+				tail = (tail + chunk)[-len(marker):]
+
 	def _test(self, deltas):
+		# ddmin retests the same input a lot, so check the cache first
+		return self._outcomes.lookup_deltas(deltas, self.stringify, self._run_test)
+
+	def _run_test(self, payload):
+		if getLogger().isEnabledFor(DEBUG):  # don't decode the input for nothing
+			debug(payload.decode("latin-1"))
+
+		if not self._fits_in_worker(payload):
+			return self._run_test_process(payload)
+
+		try:
+			worker = self._workers.get_nowait()
+		except Empty:
+			worker = self._start_worker()
+
+		try:
+			returncode = self._run_in_worker(worker, payload)
+		except TimeoutExpired:
+			# Either way, we can't trust this worker anymore
+			self._stop_worker(worker)
+			if self.timeout is not None:
+				# It had as long as a test gets, no point trying again
+				info("Timed out after %s seconds" % self.timeout)
+				return self.UNRESOLVED
+			# The input may have left sqlite waiting for something we
+			# didn't spot, so give it as long as it needs on its own
+			debug("sqlite worker didn't finish, running the test by itself")
+			return self._run_test_process(payload)
+
+		if returncode is None:
+			# It lived through the input, so there was no crash.  Errors
+			# just mean the syntax was wrong.
+			self._workers.put(worker)
+			return self.PASS
+
+		self._stop_worker(worker)
+		if self._check_returncode(returncode) == self.PASS:
+			return self.PASS
+		# The crash may be down to what earlier tests left behind in the
+		# worker (e.g. a damaged heap), so check it against a fresh sqlite
+		debug("sqlite worker exited with %d, running the test by itself" % returncode)
+		return self._run_test_process(payload)
+
+	def _run_test_process(self, payload):
 		# Build input
 		#input_filename = mkstemp(prefix="sqlite3-crash-", suffix=".sql")[1]
 		#db_filename = mkstemp(prefix="sqlite3-", suffix=".db")[1]
 
 		_args = [self.executable]
-		p = Popen(_args, universal_newlines=True, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
+		p = Popen(_args, stdin=PIPE, stdout=PIPE, stderr=STDOUT, start_new_session=True)
 		#with open(input_filename, "wb") as f:
-		s = ""
-		for (index, byte) in deltas:
-			#f.write(bytes([byte]))
-			p.stdin.write(chr(byte))
-			s += chr(byte)
-		debug(s)
-		p.stdin.close()
-		p.wait()
+		# Feed the input and read the output at the same time, so
+		# neither side can block on a full pipe
+		try:
+			p.communicate(input=payload, timeout=self.timeout)
+		except TimeoutExpired:
+			killpg(p.pid, SIGKILL)  # the target and anything it started
+			p.communicate()
+			info("Timed out after %s seconds" % self.timeout)
+			return self.UNRESOLVED
 
 		# Clean up our remporary files
 		#unlink(input_filename)
 		#unlink(db_filename)
 
-		#info("Return code: %d" % p.returncode)
-		if p.returncode == 0:
+		return self._check_returncode(p.returncode)
+
+	def _check_returncode(self, returncode):
+		#info("Return code: %d" % returncode)
+		if returncode == 0:
 			return self.PASS
 		# This means the syntax was wrong, but it doesn't mean it crashed!
-		if p.returncode == 1:
+		if returncode == 1:
 			return self.PASS
-		info("Return code: %d" % p.returncode)
+		info("Return code: %d" % returncode)
 		return self.FAIL
 
 	def stringify(self, deltas):
-		data = []
-		for (index, byte) in deltas:
-			data.append(byte)
-		return "".join(data)
+		return build_payload(self.data, deltas)
 
 if __name__ == '__main__':
 	parser = ArgumentParser(description=("Sample program to find the minimum input which "
@@ -74,6 +246,10 @@ if __name__ == '__main__':
 	parser.add_argument('--input-file', default=None,
 				help=('The filename of the crashing input (Default: stdin)'))
 	parser.add_argument('--target-args', default="", help="The arguments to pass to the target binary")
+	parser.add_argument('--jobs', type=int, default=1,
+				help=('The number of tests to run in parallel (Default: 1)'))
+	parser.add_argument('--timeout', type=float, default=None,
+				help=('Give up on a test after this many seconds (Default: no limit)'))
 	parser.add_argument('-q', action='store_true', help=('Quite mode (overrides -v if both are given)'))
 	parser.add_argument('-v', action='store_true', help=('Verbose output (for debugging issues)'))
 
@@ -86,32 +262,33 @@ if __name__ == '__main__':
 		loglevel = INFO
 
 	basicConfig(format="[%(levelname)s] %(asctime)s - %(message)s", level=loglevel)
+	# Load the input file, each delta is the offset of one of its bytes
 	if args.input_file:
 		debug("Using input file: %s" % args.input_file)
-		infile = open(args.input_file, "rb")
+		with open(args.input_file, "rb") as infile:
+			data = infile.read()
 	else:
-		infile = stdin
-
-	# Load deltas from input file
-	deltas = []
-	index = 1
-	for character in infile.read():
-		deltas.append((index, character))
-		index = index + 1
+		data = stdin.buffer.read()
+	deltas = list(range(len(data)))
 
 	if args.target_args:
 		mydd = MyDD(args.executable, args.target_args.split(" "), loglevel)
 	else:
 		mydd = MyDD(args.executable, [], loglevel)
+	mydd.jobs = args.jobs
+	mydd.timeout = args.timeout
+	mydd.data = data
 	info("Simplifying failure-inducing input...")
-	c = mydd.ddmin(deltas)              # Invoke DDMIN
+	try:
+		c = mydd.ddmin(deltas)              # Invoke DDMIN
+	finally:
+		mydd.close()
 	with open("crash-minimal.sql", "wb") as f:
-		for (index, byte) in c:
-			f.write(bytes([byte]))
+		f.write(mydd.stringify(c))
 	info("The 1-minimal failure-inducing input has been saved to crash-minimal.sql")
 	info("Removing any element will make the failure go away.")
 
 	# debug("Isolating the failure-inducing difference...")
 	# (c, c1, c2) = mydd.dd(deltas)	# Invoke DD
-	# info("The 1-minimal failure-inducing difference is", c)
-	# info(mydd.stringify(c1), "passes,", mydd.stringify(c2), "fails")
+	# info("The 1-minimal failure-inducing difference is %s", c)
+	# info("%r passes, %r fails", mydd.stringify(c1), mydd.stringify(c2))